@@ -3,9 +3,59 @@
 # Author: Eduardo Vannini
 # Date: 22-02-2020
 
+import math
 import numpy as np
 from Simulator import Simulator
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba est optionnel: sans lui, les boucles decorees avec 'njit' sont executees en Python pur
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
+@njit(cache=True)
+def _bb_theta_simulate(theta_rad, all_x, all_u, all_y, n_steps, dt, m, r, g, rho, v, l, d, b, kf, jb, theta_offset,
+                       stat_bound, stat_spd_coeff, ff_pow):
+    # Boucle de simulation de 'BBThetaSimulator' (sans bruit) ecrite uniquement avec des scalaires, afin de pouvoir
+    # etre compilee par Numba. Elle reproduit exactement 'simulate', 'update_state', 'dudt' et 'dxdt' de ce simulateur.
+    buffer_size = all_x.shape[0]
+    for k in range(n_steps):
+        all_u[k, 0] = theta_rad[k] + theta_offset
+        if k + 1 < buffer_size:
+            theta = all_u[k, 0]
+            if k == 0:
+                dtheta_dt = 0.0
+            elif k == 1:
+                dtheta_dt = (all_u[k, 0] - all_u[k - 1, 0]) / dt
+            elif k == 2:
+                dtheta_dt = (3/2 * all_u[k, 0] - 2 * all_u[k - 1, 0] + 1/2 * all_u[k - 2, 0]) / dt
+            else:
+                dtheta_dt = (11/6 * all_u[k, 0] - 3 * all_u[k - 1, 0] + 3/2 * all_u[k - 2, 0] -
+                             1/3 * all_u[k - 3, 0]) / dt
+            pos, spd = all_x[k, 0], all_x[k, 1]
+            alpha = math.asin(d / b * math.sin(theta))
+            dalpha_dt = d * math.cos(theta) * dtheta_dt / (l * math.sqrt(1 - (d * math.sin(theta) / l) ** 2))
+            x1_pow = abs(spd) ** ff_pow * np.sign(spd)
+            dx1_dt = spd
+            dx2_dt = (m * pos * dalpha_dt ** 2 - math.sin(alpha) * (m - rho * v) * g - kf * x1_pow) / (jb / r ** 2 + m)
+            if abs(theta) + stat_bound / stat_spd_coeff * abs(dx1_dt) < stat_bound:
+                dx1_dt = 0.0
+                dx2_dt = 0.0
+
+            new_pos = pos + dt * dx1_dt
+            if new_pos > l / 2:
+                all_x[k + 1, 0] = l / 2
+                all_x[k + 1, 1] = 0.0
+            elif new_pos < -l / 2:
+                all_x[k + 1, 0] = -l / 2
+                all_x[k + 1, 1] = 0.0
+            else:
+                all_x[k + 1, 0] = new_pos
+                all_x[k + 1, 1] = spd + dt * dx2_dt
+        all_y[k, 0] = all_x[k, 0]
+
 
 class BBSimulator(Simulator):
     """
@@ -180,6 +230,46 @@ class BBThetaSimulator(BBAlphaSimulator):
         return super().simulate(lambda *args, **kwargs: command_func(*args, **kwargs) + self.params["theta_offset"],
                                 command_noise_func, output_noise_func, n_steps, init_state)
 
+    def _uses_bb_theta_dynamics(self):
+        # Vrai si aucune des methodes reproduites par '_bb_theta_simulate' n'est redefinie par la classe de 'self'
+        cls = type(self)
+        return (cls.dxdt is BBThetaSimulator.dxdt and cls.update_state is BBAlphaSimulator.update_state and
+                cls.dudt is Simulator.dudt and cls.y is BBSimulator.y and cls.simulate is BBThetaSimulator.simulate)
+
+    def simulate_array(self, commands, command_noise_func=None, output_noise_func=None, n_steps=None,
+                       init_state=np.zeros((2,))):
+        # Sans bruit, meme resultat que la version generique, mais toute la boucle est executee par
+        # '_bb_theta_simulate' (compilee si Numba est installe). Ce noyau reproduit la dynamique de cette classe-ci:
+        # une sous-classe qui la modifie (p.ex. 'BBObj7Simulator') revient donc a la version generique.
+        if command_noise_func is not None or output_noise_func is not None or not self._uses_bb_theta_dynamics():
+            return super().simulate_array(commands, command_noise_func, output_noise_func, n_steps, init_state)
+
+        n_steps = len(commands) if n_steps is None else n_steps
+        if np.size(init_state) == 1 and self.n_states != 1:
+            init_state = np.full((self.n_states,), init_state)
+        if np.abs(init_state[0]) > self.params["l"] / 2:
+            raise ValueError("Initial position is not on the beam")
+
+        n = min(self.buffer_size, n_steps)
+        if n > len(commands):
+            # Sous Numba, '_bb_theta_simulate' ne verifie pas les indices et lirait au-dela de 'commands'
+            raise ValueError("Not enough commands for the requested number of steps")
+        self.all_x = np.zeros((self.buffer_size, self.n_states))
+        self.all_u = np.zeros((self.buffer_size, self.n_commands))
+        self.all_y = np.zeros((self.buffer_size, self.n_outputs))
+        self.all_u_noise[:n] = 0
+        self.all_y_noise[:n] = 0
+        self.all_x[0] = init_state
+
+        p = self.params
+        _bb_theta_simulate(np.ascontiguousarray(commands, dtype=np.float64), self.all_x, self.all_u, self.all_y, n,
+                           self.dt, p["m"], p["r"], p["g"], p["rho"], p["v"], p["l"], p["d"], p["b"], p["kf"], p["jb"],
+                           p["theta_offset"], p["stat_bound"], p["stat_spd_coeff"], p["ff_pow"])
+        self.timestep = n
+
+        if self.timestep == self.buffer_size and self.buffer_size <= n_steps < np.inf:
+            raise RuntimeWarning("Simulation stopped as the simulation buffer is full.")
+
 
 class BBObj7Simulator(BBThetaSimulator):
     """
@@ -202,6 +202,27 @@ class Simulator(abc.ABC):
         if self.timestep == self.buffer_size and self.buffer_size <= n_steps < np.inf:
             raise RuntimeWarning("Simulation stopped as the simulation buffer is full.")
 
+    def simulate_array(self, commands, command_noise_func=None, output_noise_func=None, n_steps=None, init_state=0):
+        """
+        Variante de 'simulate' pour une simulation en boucle ouverte, dans laquelle toute la commande est connue a
+        l'avance: la commande au temps 'timestep' est 'commands[timestep]'. Par defaut, cette methode se contente
+        d'appeler 'simulate', mais les sous-classes peuvent la redefinir pour effectuer la simulation sans appeler
+        de fonction Python a chaque pas de temps.
+
+        :param commands           : Array contenant la commande pour chaque pas de temps.
+        :param command_noise_func : Fonction de bruit sur la commande telle qu'acceptee par 'simulate', ou None
+                                    pour ne pas mettre de bruit.
+        :param output_noise_func  : Fonction de bruit sur la sortie telle qu'acceptee par 'simulate', ou None
+                                    pour ne pas mettre de bruit.
+        :param n_steps            : Nombre de pas de temps desires. Par defaut, la longueur de 'commands'.
+        :param init_state         : Etat initial du systeme sous forme d'un array comportant 'n_states' elements.
+        :return                   : None
+        """
+        no_noise = lambda *args, **kwargs: 0
+        return self.simulate(lambda timestep, *args, **kwargs: commands[timestep], command_noise_func or no_noise,
+                             output_noise_func or no_noise, len(commands) if n_steps is None else n_steps,
+                             init_state)
+
 
 # La suite du code ne sera executee que si le fichier 'Simulator.py' est lance directement. Elle ne le sera pas si ce
 # fichier est utilise comme import dans un autre fichier. La section ci-dessous sert de code de demonstration pour
@@ -3,12 +3,45 @@
 # Author: Eduardo Vannini
 # Date: 27-02-20
 
+import os
+import mmap
 import numpy as np
-import pandas as pd
 import scipy.optimize as opt
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import matplotlib.pyplot as plt
 
 
+# Suffixe des fichiers de cache binaires crees a cote des donnees experimentales (voir 'read_bb_test_output')
+_DATA_CACHE_SUFFIX = ".cache.npy"
+
+# Fonctions utilisees par les methodes de fit de 'Tests'. Elles sont definies au niveau du module pour pouvoir etre
+# serialisees avec 'pickle' et utilisees par les processus quand 'workers' > 1.
+
+_fit_worker_state = {}
+
+
+def _fit_sim_error(bbsimulator, theta_rad, pos_m, init_state, command_noise_func, output_noise_func, err_pow):
+    # Simule un fichier de donnees et retourne l'erreur correspondante
+    bbsimulator.simulate_array(theta_rad, command_noise_func, output_noise_func, n_steps=pos_m.size,
+                               init_state=init_state)
+    return Tests.sim_error(bbsimulator.all_y[:pos_m.size], pos_m, err_pow)
+
+
+def _init_fit_worker(bbsimulator, preloaded, command_noise_func, output_noise_func, err_pow):
+    # Appelee une seule fois par processus: chacun recoit sa propre copie du simulateur et des donnees
+    _fit_worker_state.update(bbsimulator=bbsimulator, preloaded=preloaded, command_noise_func=command_noise_func,
+                             output_noise_func=output_noise_func, err_pow=err_pow)
+
+
+def _fit_worker_err(task):
+    # Simule le fichier d'indice 'i' avec les parametres 'params' et retourne l'erreur correspondante
+    params, i = task
+    bbsimulator = _fit_worker_state["bbsimulator"]
+    bbsimulator.params.update(params)
+    return _fit_sim_error(bbsimulator, *_fit_worker_state["preloaded"][i], _fit_worker_state["command_noise_func"],
+                          _fit_worker_state["output_noise_func"], _fit_worker_state["err_pow"])
+
+
 class Tests:
     """
     Collection de methodes statiques en rapport avec les tests (creation, visualisation, etc.). Rien de tres important
@@ -24,25 +57,64 @@ class Tests:
         :param theta    : Vecteur des angles de commande du servo, en degres.
         :return         : None
         """
-        np.savetxt(out_path, theta, fmt="%.7e")
-        with open(out_path, "r") as f:
-            old = f.read()
+        # Formatage et remplacement du separateur decimal en memoire: le fichier n'est ecrit qu'une seule fois.
+        lines = np.char.replace(np.char.mod("%.7e", np.asarray(theta, dtype=np.float64).ravel()), ".", ",")
         with open(out_path, "w") as f:
-            f.write(old.replace(".", ","))
+            f.write("\n".join(lines) + "\n")
+
+    @staticmethod
+    def write_theta_npy(out_path, theta):
+        """
+        Methode statique qui permet d'ecrire un vecteur d'angles 'theta' (degres) dans un fichier binaire '.npy'.
+        Ce format n'est pas lisible par LabVIEW, mais il est plus compact et beaucoup plus rapide a ecrire et a
+        relire que le format texte de 'write_theta'. A utiliser pour les tests qui restent cote Python.
+
+        :param out_path : Chemin du fichier ou le test sera ecrit (ecrase tout fichier de meme nom!). Numpy ajoute
+                          l'extension '.npy' si elle n'est pas presente.
+        :param theta    : Vecteur des angles de commande du servo, en degres.
+        :return         : None
+        """
+        np.save(out_path, np.asarray(theta, dtype=np.float64))
+
+    @staticmethod
+    def read_theta_npy(test_path):
+        """
+        Methode statique qui permet de relire un vecteur d'angles ecrit par 'Tests.write_theta_npy'.
+
+        :param test_path : Chemin vers le fichier '.npy' a lire.
+        :return          : Vecteur des angles de commande du servo, en degres.
+        """
+        return np.load(test_path)
 
     @staticmethod
     def plot_test(test_path, dt):
         """
         Methode statique qui permet de visualiser le contenu d'un fichier de tests situe au chemin 'test_path'.
-        Ce fichier de tests est tel que ceux ecrits par la methode statique 'Tests.write_theta'.
+        Ce fichier de tests est tel que ceux ecrits par les methodes statiques 'Tests.write_theta' ou
+        'Tests.write_theta_npy' (si son extension est '.npy').
 
         :param test_path : Chemin vers le fichier de test a visualiser.
         :param dt        : Periode d'echantillonnage utilisee dans ce fichier, en secondes.
         :return          : None
         """
-        with open(test_path, "r") as f:
-            theta = np.array(list(map(lambda s: float(s.replace(",", ".")), f.read().split())))
-        plt.plot(np.arange(0, theta.size * dt, dt), theta)
+        if test_path.endswith(".npy"):
+            theta = Tests.read_theta_npy(test_path)
+        else:
+            theta = np.loadtxt(test_path, dtype=np.float64, ndmin=1, converters=lambda s: float(s.replace(",", ".")))
+        plt.plot(np.arange(theta.size) * dt, theta)
+
+    @staticmethod
+    def n_samples(duration, dt):
+        """
+        Methode statique qui donne le nombre d'echantillons contenus dans une duree 'duration' [s] echantillonnee
+        avec une periode 'dt' [s]. L'arrondi evite les erreurs d'un echantillon dues a la representation des
+        flottants (e.g. int(0.3 / 0.1) vaut 2), qu'on aurait aussi avec np.arange(0, duration, dt).
+
+        :param duration : Duree, en secondes.
+        :param dt       : Periode d'echantillonnage, en secondes.
+        :return         : Le nombre d'echantillons (entier).
+        """
+        return int(round(duration / dt))
 
     @staticmethod
     def write_test_1(out_path, angle_deg, dt, t_max, offset=0):
@@ -57,9 +129,8 @@ class Tests:
                            du systeme reel.
         :return          : None
         """
-        t = np.arange(0, t_max, dt)
-        theta = np.full(t.shape, fill_value=angle_deg)
-        theta += offset
+        n = Tests.n_samples(t_max, dt)
+        theta = np.full(n, fill_value=angle_deg + offset, dtype=np.float64)
         Tests.write_theta(out_path, theta)
 
     @staticmethod
@@ -77,7 +148,8 @@ class Tests:
                              du systeme reel.
         :return            : None
         """
-        theta = np.linspace(angle_deg_1, angle_deg_2, int(t_max / dt))
+        n = Tests.n_samples(t_max, dt)
+        theta = np.linspace(angle_deg_1, angle_deg_2, n)
         theta += offset
         Tests.write_theta(out_path, theta)
 
@@ -96,8 +168,12 @@ class Tests:
                           du systeme reel.
         :return         : None
         """
-        t = np.arange(0, t_max, dt)
-        theta = a * np.sin(2 * np.pi / p * t)
+        n = Tests.n_samples(t_max, dt)
+        omega = 2 * np.pi / p
+        theta = np.arange(n, dtype=np.float64)
+        theta *= dt * omega  # theta = omega * t, calcule en place
+        np.sin(theta, out=theta)
+        theta *= a
         theta += offset
         Tests.write_theta(out_path, theta)
 
@@ -122,12 +198,13 @@ class Tests:
                           du systeme reel.
         :return         : None
         """
-        t = np.arange(0, t_max, dt)
-        theta = np.zeros(t.shape)
-        theta[:int(t1 / dt)] = a1
-        theta[int(t1 / dt):int(t1 / dt) + int(t2 / dt)] = a2
-        theta[int(t1 / dt) + int(t2 / dt):] = 0
-        theta += offset
+        # Nombres d'echantillons de chaque etape, calcules une seule fois
+        n1, n2, n_tot = Tests.n_samples(t1, dt), Tests.n_samples(t2, dt), Tests.n_samples(t_max, dt)
+        n12 = n1 + n2
+        n3 = max(n_tot - n12, 0)
+        theta = np.concatenate((np.full(n1, a1 + offset, dtype=np.float64),
+                                np.full(n2, a2 + offset, dtype=np.float64),
+                                np.full(n3, offset, dtype=np.float64)))[:n_tot]
         Tests.write_theta(out_path, theta)
 
     @staticmethod
@@ -144,8 +221,15 @@ class Tests:
                           du systeme reel.
         :return         : None
         """
-        t = np.arange(0, t_max, dt)
-        theta = np.sin(t * 2 * np.pi / p) * np.exp(t / 7)
+        n = Tests.n_samples(t_max, dt)
+        omega, inv7 = 2 * np.pi / p, 1 / 7
+        t = np.arange(n, dtype=np.float64) * dt
+        # Operations en place pour eviter les tableaux temporaires
+        theta = np.multiply(t, omega)
+        np.sin(theta, out=theta)
+        t *= inv7  # 't' n'est plus utilise: il sert de buffer pour l'exponentielle
+        np.exp(t, out=t)
+        theta *= t
         theta += offset
         Tests.write_theta(out_path, theta)
 
@@ -161,10 +245,16 @@ class Tests:
         :param data_path : Chemin vers le fichier a modifier.
         :return          : None
         """
-        with open(data_path, "r") as f:
-            old = f.read()
-        with open(data_path, "w") as f:
-            f.write(old.replace(",", "."))
+        if os.path.getsize(data_path) == 0:
+            return  # Un fichier vide ne peut pas etre mappe en memoire (et il n'y a rien a remplacer)
+
+        # "," et "." font tous deux un octet: le remplacement se fait directement dans le fichier mappe en memoire,
+        # sans decodage du texte ni reecriture complete du fichier.
+        with open(data_path, "r+b") as f, mmap.mmap(f.fileno(), 0) as mm:
+            data = np.frombuffer(mm, dtype=np.uint8)
+            data[data == ord(",")] = ord(".")
+            del data  # Liberer la vue sur 'mm' avant sa fermeture
+            mm.flush()
 
     @staticmethod
     def update_decimal_sep_dir(dir_path):
@@ -175,57 +265,215 @@ class Tests:
         Note: Si d'autres fichiers que des fichiers de donnees LabVIEWse trouvent dans le reperoire, ils seront
               aussi modifies (leurs "," deviendront des ".").
 
+        Les fichiers sont traites en parallele par plusieurs threads (le travail est domine par les entrees/sorties).
+
+        Les fichiers de cache crees par 'read_bb_test_output' (suffixe '_DATA_CACHE_SUFFIX') sont ignores.
+
         :param dir_path : Chemin vers le repertoire contenant les fichiers a modifier.
         :return         : None
         """
-        for filename in os.listdir(dir_path):
-            Tests.update_decimal_sep(os.path.join(dir_path, filename))
+        with ThreadPoolExecutor() as executor:
+            # 'list' force la recuperation des resultats, et donc la propagation d'eventuelles exceptions
+            list(executor.map(Tests.update_decimal_sep,
+                              [os.path.join(dir_path, filename) for filename in os.listdir(dir_path)
+                               if not filename.endswith(_DATA_CACHE_SUFFIX)]))
+
+    @staticmethod
+    def read_bb_test_output(data_path, use_cache=True):
+        """
+        Methode statique qui lit un fichier de donnees experimentales du Ball and Beam du P4 MAP (format LabVIEW).
+        Seules les trois premieres colonnes (pas de temps, angle, position) sont lues.
+
+        Le resultat du parsing est mis en cache dans un fichier binaire voisin ('data_path' + '_DATA_CACHE_SUFFIX'),
+        avec la date de modification (en ns) et la taille de 'data_path' au moment du parsing. Le cache n'est relu
+        que si ces deux valeurs n'ont pas change: toute modification du fichier texte (p.ex. par 'update_decimal_sep')
+        l'invalide donc. Un cache illisible (p.ex. ecriture interrompue) est simplement recree.
+
+        Note: Le fichier situe en 'data_path' doit avoir ete traite avec 'update_decimal_dep' pour
+              etre utilisable.
+
+        :param data_path : Chemin vers le fichier contenant les donnees experimentales.
+        :param use_cache : Si False, le fichier texte est toujours parse et le cache n'est ni lu ni ecrit.
+        :return          : Un tuple (ts, theta_deg, pos_cm) avec:
+                               - ts        : Array des numeros de pas de temps;
+                               - theta_deg : Array des angles commandes, en degres;
+                               - pos_cm    : Array des positions mesurees, en centimetres.
+        """
+        cache_path = data_path + _DATA_CACHE_SUFFIX
+        if use_cache:
+            # Releve avant le parsing: une modification pendant celui-ci rendra le cache obsolete des le prochain appel
+            stat = os.stat(data_path)
+            source_id = np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+            try:
+                with open(cache_path, "rb") as f:
+                    if np.array_equal(np.load(f), source_id):
+                        ts, theta_deg, pos_cm = np.load(f)
+                        return ts, theta_deg, pos_cm
+            except (OSError, ValueError, EOFError):
+                pass  # Cache absent ou endommage: il est recree ci-dessous
+
+        data = np.loadtxt(data_path, dtype=np.float64, delimiter="\t", skiprows=3,
+                          usecols=(0, 1, 2), unpack=True, ndmin=2, encoding="latin1")
+        if use_cache:
+            # Ecriture dans un fichier temporaire puis remplacement atomique: un cache n'est jamais a moitie ecrit
+            tmp_path = "%s.%d%s" % (data_path, os.getpid(), _DATA_CACHE_SUFFIX)
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, source_id)
+                    np.save(f, data)
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass  # Repertoire en lecture seule, disque plein, ... : on se passe du cache
+            finally:
+                if os.path.exists(tmp_path):
+                    try:
+                        os.remove(tmp_path)
+                    except OSError:
+                        pass
+        ts, theta_deg, pos_cm = data
+        return ts, theta_deg, pos_cm
+
+    @staticmethod
+    def bb_sim_inputs(theta_deg, pos_cm, dt):
+        """
+        Methode statique qui convertit des donnees experimentales en entrees pour un simulateur 'BBSimulator':
+        angles en radians, positions en metres et etat initial [position, vitesse] de la bille.
+
+        :param theta_deg : Array des angles commandes, en degres.
+        :param pos_cm    : Array des positions mesurees, en centimetres.
+        :param dt        : Periode d'echantillonnage utilisee dans le fichier d'observations experimentales.
+        :return          : Un tuple (theta_rad, pos_m, init_state) avec:
+                               - theta_rad  : Array des angles commandes, en radians;
+                               - pos_m      : Array des positions mesurees, en metres;
+                               - init_state : Etat initial [position, vitesse] de la bille.
+        """
+        pos_m = pos_cm / 100
+        init_state = np.zeros((2,))
+        init_state[0] = pos_m[0]
+        init_state[1] = (pos_m[1] - pos_m[0]) / dt
+        return np.deg2rad(theta_deg), pos_m, init_state
 
     @staticmethod
-    def plot_bb_test_output(data_path, dt, title=None, pos_lims=(-0.775 / 2, 0.775 / 2), theta_lims=(-50, 50)):
+    def load_bb_test_output(data_path, dt):
+        """
+        Methode statique qui charge un fichier de donnees experimentales du Ball and Beam du P4 MAP et le
+        convertit directement en entrees pour un simulateur (voir 'read_bb_test_output' et 'bb_sim_inputs').
+
+        :param data_path : Chemin vers le fichier contenant les donnees experimentales.
+        :param dt        : Periode d'echantillonnage utilisee dans le fichier d'observations experimentales.
+        :return          : Un tuple (theta_rad, pos_m, init_state), tel que retourne par 'bb_sim_inputs'.
+        """
+        _, theta_deg, pos_cm = Tests.read_bb_test_output(data_path)
+        return Tests.bb_sim_inputs(theta_deg, pos_cm, dt)
+
+    @staticmethod
+    def sim_error(sim_y, pos_m, err_pow=2):
+        """
+        Methode statique qui calcule la somme des erreurs (elevees a la puissance 'err_pow') entre une sortie simulee
+        et les positions mesurees experimentalement.
+
+        :param sim_y   : Sortie du simulateur, de meme longueur que 'pos_m' (e.g. 'all_y[:n]').
+        :param pos_m   : Array des positions mesurees, en metres.
+        :param err_pow : Puissance a appliquer lors du calcul de l'erreur.
+        :return        : L'erreur totale.
+        """
+        # Volontairement en double precision: en np.float32, la somme est trop grossiere pour le gradient par
+        # differences finies des optimiseurs (SLSQP s'arrete alors au point de depart).
+        diff = sim_y.ravel() - pos_m
+        if err_pow == 2:
+            # Cas le plus courant: un simple produit scalaire, sans tableaux temporaires supplementaires
+            return diff @ diff
+        return np.sum(np.power(np.abs(diff), err_pow))
+
+    @staticmethod
+    def plot_bb_test_output(data_path, dt, title=None, pos_lims=(-0.775 / 2, 0.775 / 2), theta_lims=(-50, 50),
+                            ax_pos=None, ax_theta=None, label=None):
         """
         Methode statique qui permet de faire un graphe pour representer des donnees experimentales du
         Ball and Beam du P4 MAP. Les donnees experimentales sont contenues dans le fichier dont le chemin
         est 'data_path' et sont formatees de la meme maniere que ce que genere LabVIEW.
 
+        Une nouvelle figure n'est creee que si ni 'ax_pos' ni 'ax_theta' ne sont specifies. Sinon, les courbes sont
+        ajoutees aux plots donnes, ce qui evite de construire une figure par fichier. Pour superposer plusieurs
+        fichiers avec une legende coherente, utiliser 'plot_many' (ou passer 'label' lors du premier appel).
+
         Note: Le fichier situe en 'data_path' doit avoir ete traite avec 'update_decimal_dep' pour
               etre utilisable.
 
         :param data_path  : Chemin vers le fichier contenant les donnees experimentales.
         :param dt         : Periode d'echantillonnage utilisee dans le fichier d'observations experimentales.
-        :param title      : Titre de la figure. Sera remplace par le nom du fichier si il n'est pas specifie.
+        :param title      : Titre de la figure. Sera remplace par le nom du fichier si il n'est pas specifie et
+                            qu'une nouvelle figure est creee.
         :param pos_lims   : Tuple contenant les valeurs limites a afficher sur le graphe des positions (permet
                             de dimensionner le graphe). Si 'pos_lims' vaut None, les limites sont automatiques.
         :param theta_lims : Tuple contenant les valeurs limites a afficher sur le graphe des angles (permet
                             de dimensionner le graphe). Si 'theta_lims' vaut None, les limites sont automatiques.
+        :param ax_pos     : Plot existant sur lequel ajouter les positions, ou None.
+        :param ax_theta   : Plot existant sur lequel ajouter les angles, ou None.
+        :param label      : Nom des courbes dans la legende. Par defaut, une description des grandeurs si une nouvelle
+                            figure est creee, et le nom du fichier si les courbes sont ajoutees a des plots existants.
         :return           : Un tuple (fig, ax_pos, _ax_theta) avec:
                                 - fig      : La figure contenant les deux plots;
-                                - ax_pos   : Le plot contenant les positions;
-                                - ax_theta : Le plot contenant les angles.
+                                - ax_pos   : Le plot contenant les positions (None si seul 'ax_theta' est donne);
+                                - ax_theta : Le plot contenant les angles (None si seul 'ax_pos' est donne).
+        """
+        ts, theta_deg, pos_cm = Tests.read_bb_test_output(data_path)
+        t = ts * dt
+        if ax_pos is None and ax_theta is None:
+            fig, ((ax_pos), (ax_theta)) = plt.subplots(2, sharex=True)
+            pos_label, theta_label = "Measured position [m]", "Commanded angle (servo) [deg]"
+            if title is None:
+                title = data_path
+        else:
+            fig = (ax_pos if ax_pos is not None else ax_theta).figure
+            pos_label = theta_label = os.path.basename(data_path)
+        if label is not None:
+            pos_label = theta_label = label
+
+        if ax_pos is not None:
+            ax_pos.plot(t, pos_cm / 100, label=pos_label)
+            ax_pos.legend()
+            ax_pos.grid(True)
+            if pos_lims:
+                ax_pos.set_ylim(pos_lims)
+            ax_pos.set_xlabel("Time [s]")
+            ax_pos.set_ylabel("Position [m]")
+        if ax_theta is not None:
+            ax_theta.plot(t, theta_deg, label=theta_label)
+            ax_theta.legend()
+            ax_theta.grid(True)
+            if theta_lims:
+                ax_theta.set_ylim(theta_lims)
+            ax_theta.set_xlabel("Time [s]")
+            ax_theta.set_ylabel("Angle [deg]")
+        if title is not None:
+            fig.suptitle(title)
+        return fig, ax_pos, ax_theta
+
+    @staticmethod
+    def plot_many(data_paths, dt, title=None, pos_lims=(-0.775 / 2, 0.775 / 2), theta_lims=(-50, 50)):
+        """
+        Methode statique qui superpose sur une seule figure les donnees experimentales de plusieurs fichiers
+        (voir 'plot_bb_test_output'). La figure n'est construite qu'une seule fois.
+
+        :param data_paths : Liste des chemins vers les fichiers contenant les donnees experimentales.
+        :param dt         : Periode d'echantillonnage utilisee dans les fichiers d'observations experimentales.
+        :param title      : Titre de la figure.
+        :param pos_lims   : Voir 'plot_bb_test_output'.
+        :param theta_lims : Voir 'plot_bb_test_output'.
+        :return           : Un tuple (fig, ax_pos, ax_theta), comme 'plot_bb_test_output'.
         """
-        df = pd.read_csv(data_path, sep="\t", index_col=0, skiprows=2, header=0, usecols=[0, 1, 2],
-                         names=["timestep", "theta_deg", "pos_cm"])
         fig, ((ax_pos), (ax_theta)) = plt.subplots(2, sharex=True)
-        ax_pos.plot(df.index * dt, df.pos_cm / 100, label="Measured position [m]")
-        ax_theta.plot(df.index * dt, df.theta_deg, label="Commanded angle (servo) [deg]")
-        ax_pos.legend()
-        ax_theta.legend()
-        ax_pos.grid()
-        ax_theta.grid()
-        if pos_lims:
-            ax_pos.set_ylim(pos_lims)
-        if theta_lims:
-            ax_theta.set_ylim(theta_lims)
-        ax_pos.set_xlabel("Time [s]")
-        ax_theta.set_xlabel("Time [s]")
-        ax_pos.set_ylabel("Position [m]")
-        ax_theta.set_ylabel("Angle [deg]")
-        fig.suptitle(data_path if title is None else title)
+        for data_path in data_paths:
+            Tests.plot_bb_test_output(data_path, dt, pos_lims=pos_lims, theta_lims=theta_lims,
+                                      ax_pos=ax_pos, ax_theta=ax_theta)
+        if title is not None:
+            fig.suptitle(title)
         return fig, ax_pos, ax_theta
 
     @staticmethod
-    def plot_bb_test_output_and_sim(data_path, bbsimulator, title=None, command_noise_func=lambda *args, **kwargs: 0,
-                                    output_noise_func=lambda *args, **kwargs: 0):
+    def plot_bb_test_output_and_sim(data_path, bbsimulator, title=None, command_noise_func=None,
+                                    output_noise_func=None):
         """
         Methode statique qui permet de faire un graphe pour representer des donnees experimentales du
         Ball and Beam du P4 MAP en les comparant aux donnees simulees pour les memes conditions.
@@ -240,26 +488,25 @@ class Tests:
         :param title              : Titre de la figure. Sera remplace par le nom du fichier si il n'est pas specifie.
         :param command_noise_func : Fonction retournant le bruit a ajouter a la commande au temps 'timestep'. Signature:
                                     command_noise_func(timestep, params, all_t, all_u, all_y, dt)
+                                    None pour ne pas mettre de bruit.
         :param output_noise_func  : Fonction retournant le bruit a ajouter a la sortie au temps 'timestep'. Signature:
                                     output_noise_func(timestep, params, all_t, all_u, all_y, dt)
+                                    None pour ne pas mettre de bruit.
         :return                   : Un tuple (fig, ax_pos, _ax_theta) avec:
                                         - fig      : La figure contenant les deux plots;
                                         - ax_pos   : Le plot contenant les positions;
                                         - ax_theta : Le plot contenant les angles.
         """
         dt, l = bbsimulator.dt, bbsimulator.params["l"]
-        df = pd.read_csv(data_path, sep="\t", index_col=0, skiprows=2, header=0, usecols=[0, 1, 2],
-                         names=["timestep", "theta_deg", "pos_cm"])
-        init_state = np.zeros((2,))
-        init_state[0] = df.pos_cm[0] / 100
-        init_state[1] = (df.pos_cm[1] - df.pos_cm[0]) / dt / 100
-        bbsimulator.simulate(lambda timestep, *args, **kwargs: np.deg2rad(df.theta_deg[timestep]),
-                             command_noise_func, output_noise_func, n_steps=df.shape[0], init_state=init_state)
+        ts, theta_deg, pos_cm = Tests.read_bb_test_output(data_path)
+        theta_rad, pos_m, init_state = Tests.bb_sim_inputs(theta_deg, pos_cm, dt)
+        n = pos_m.size
+        bbsimulator.simulate_array(theta_rad, command_noise_func, output_noise_func, n_steps=n, init_state=init_state)
 
         fig, ((ax_pos), (ax_theta)) = plt.subplots(2, sharex=True)
-        ax_pos.plot(df.index * dt, df.pos_cm / 100, label="Measured position [m]")
-        ax_pos.plot(bbsimulator.all_t[:df.shape[0]], bbsimulator.all_y[:df.shape[0]], label="Simulated position [m]")
-        ax_theta.plot(df.index * dt, df.theta_deg, label="Commanded angle (servo) [deg]")
+        ax_pos.plot(ts * dt, pos_m, label="Measured position [m]")
+        ax_pos.plot(bbsimulator.all_t[:n], bbsimulator.all_y[:n], label="Simulated position [m]")
+        ax_theta.plot(ts * dt, theta_deg, label="Commanded angle (servo) [deg]")
         ax_pos.legend()
         ax_theta.legend()
         ax_pos.grid()
@@ -281,8 +528,7 @@ class Tests:
 
     @staticmethod
     def fit_bb_sim_params(training_data_paths, param_names, bbsimulator, method="SLSQP", err_pow=2, init_params=None,
-                          bounds=None, tol=None, command_noise_func=lambda *args, **kwargs: 0,
-                          output_noise_func=lambda *args, **kwargs: 0):
+                          bounds=None, tol=None, command_noise_func=None, output_noise_func=None, workers=1):
         """
         Methode statique permettant d'optimiser les parametres 'param_names' du simulateur 'bbsimulator' afin
         de minimiser la somme des erreurs sur l'ensemble des fichiers de donnees experimentales dont les chemins sont
@@ -294,13 +540,18 @@ class Tests:
         (attention, certaines methodes ne sont pas compatibles avec l'utilisation de bornes).
 
         Du bruit peut etre pris en compte dans la simulation avec les arguments 'command_noise_func' et
-        'output_noise_func', mais par defaut il n'y en a pas.
+        'output_noise_func', mais par defaut il n'y en a pas. Les simulations passent par
+        'bbsimulator.simulate_array', beaucoup plus rapide sans bruit pour un 'BBThetaSimulator'.
 
         Note importante: les parametres de l'objet 'bbsimulator' sont modifies durant le processus, mais rien
                          ne garantit qu'ils soient optimals a la fin. Les parametres optimaux sont a lire
                          dans l'objet 'OptimizationResult' retourne par la fonction et sont a appliquer
                          a la main si l'erreur semble satisfaisante.
 
+        Les simulations des differents fichiers de donnees sont independantes: avec 'workers' > 1, elles sont
+        reparties sur plusieurs processus, chacun travaillant sur sa propre copie de 'bbsimulator'. Dans ce cas,
+        'bbsimulator' et les fonctions de bruit doivent pouvoir etre serialises avec 'pickle' (pas de lambda).
+
         :param training_data_paths : Liste des chemins vers les fichiers de donnees experimentales LabVIEW.
                                      Les separateurs decimaux doivent etre remplaes par des ".".
         :param param_names         : Liste des noms des parametres sur lesquels l'optimisation peut s'effectuer.
@@ -315,14 +566,19 @@ class Tests:
         :param err_pow             : Puissance a appliquer lors du calcul de l'erreur, permet de penaliser ou non les
                                      grosses deviations par rapport aux petites.
         :param command_noise_func  : Fonction de bruit sur la commande telle qu'acceptee par la methode
-                                     'bbsimulator.simulate'.
+                                     'bbsimulator.simulate', ou None pour ne pas mettre de bruit.
         :param output_noise_func   : Fonction de bruit sur la mesure telle qu'acceptee par la methode
-                                     'bbsimulator.simulate'.
+                                     'bbsimulator.simulate', ou None pour ne pas mettre de bruit.
+        :param workers             : Nombre de processus sur lesquels repartir les simulations. Avec 1, tout est
+                                     execute dans le processus courant.
         :return                    : Objet 'OptimizationResult' contenant le resultat de l'optimisation.
         """
         # Memoization pour un leger speedup
         already_seen = {}
 
+        # Les fichiers de donnees ne sont lus qu'une seule fois, et pas a chaque appel de 'err_func'
+        preloaded = [Tests.load_bb_test_output(data_path, bbsimulator.dt) for data_path in training_data_paths]
+
         def err_func(param_values):
             """
             Fonction retournant la somme des erreurs sur l'ensemble des fichiers de test. On desire minimiser
@@ -340,17 +596,14 @@ class Tests:
                 bbsimulator.params[param_name] = param_value
 
             tot_err = 0
-            for data_path in training_data_paths:
-                df = pd.read_csv(data_path, sep="\t", index_col=0, skiprows=2, header=0, usecols=[0, 1, 2],
-                                 names=["timestep", "theta_deg", "pos_cm"])
-                init_state = np.zeros((2,))
-                init_state[0] = df.pos_cm[0] / 100
-                init_state[1] = (df.pos_cm[1] - df.pos_cm[0]) / bbsimulator.dt / 100
-                bbsimulator.simulate(lambda timestep, *args, **kwargs: np.deg2rad(df.theta_deg[timestep]),
-                                     command_noise_func, output_noise_func, n_steps=df.shape[0], init_state=init_state)
-                partial_err = np.sum(np.power(np.abs(bbsimulator.all_y[:df.shape[0]].flatten() - df.pos_cm / 100),
-                                              err_pow))
-                tot_err += partial_err
+            if executor is not None:
+                # Seules les valeurs des parametres sont envoyees aux processus, les donnees y sont deja chargees
+                params = dict(zip(param_names, param_values))
+                tot_err = sum(executor.map(_fit_worker_err, [(params, i) for i in range(len(preloaded))]))
+            else:
+                for theta_rad, pos_m, init_state in preloaded:
+                    tot_err += _fit_sim_error(bbsimulator, theta_rad, pos_m, init_state, command_noise_func,
+                                              output_noise_func, err_pow)
 
             print("Parameters: {}\nMean error per file: {}\n"
                   "".format(np.round(param_values, 5), tot_err / len(training_data_paths)))
@@ -379,12 +632,21 @@ class Tests:
                     init_params[i] = 0.5 * (bound[1] - bound[0]) * (1 + init_params[i])
 
         # Methodes possibles avec 'bounds': "TNC", "L-BFGS-B", "SLSQP", "trust-constr"
-        return opt.minimize(err_func, np.array(init_params), method=method, bounds=bounds, tol=tol)
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_fit_worker,
+                                           initargs=(bbsimulator, preloaded, command_noise_func, output_noise_func,
+                                                     err_pow))
+        try:
+            return opt.minimize(err_func, np.array(init_params), method=method, bounds=bounds, tol=tol)
+        finally:
+            if executor is not None:
+                executor.shutdown()
 
     @staticmethod
     def fit_static_friction(training_data_paths, bbsimulator, Ns=1000, err_pow=2,
-                            ranges = ((0, np.deg2rad(20)), (0.01, 0.20)), command_noise_func=lambda *args, **kwargs: 0,
-                            output_noise_func=lambda *args, **kwargs: 0):
+                            ranges = ((0, np.deg2rad(20)), (0.01, 0.20)), command_noise_func=None,
+                            output_noise_func=None):
         """
         Methode statique permettant d'optimiser les parametres 'stat_bound' et 'stat_spd_coeff' qui controlent le
         frottement statique dans le simulateur 'bbsimulator'. Puisque le critere de frottement statique donne un
@@ -414,14 +676,18 @@ class Tests:
         :param ranges              : Tuple de couples (min, max) qui definissent la zone de recherche de la brute force.
                                      Voir la documentation de 'scipy.optimize.brute' pour plus de details.
         :param command_noise_func  : Fonction de bruit sur la commande telle qu'acceptee par la methode
-                                     'bbsimulator.simulate'.
+                                     'bbsimulator.simulate', ou None pour ne pas mettre de bruit.
         :param output_noise_func   : Fonction de bruit sur la mesure telle qu'acceptee par la methode
-                                     'bbsimulator.simulate'.
+                                     'bbsimulator.simulate', ou None pour ne pas mettre de bruit.
         :return                    : Objet 'OptimizationResult' contenant le resultat de l'optimisation.
         """
 
         run_count = [1]  # Une liste comme ca err_func peut le modifier. Je sais, c'est sale, but it works ^^
         tot_runs = Ns ** 2
+
+        # Les fichiers de donnees ne sont lus qu'une seule fois, et pas a chaque point de la grille
+        preloaded = [Tests.load_bb_test_output(data_path, bbsimulator.dt) for data_path in training_data_paths]
+
         def err_func(param_values):
             """
             Fonction retournant la somme des erreurs sur l'ensemble des fichiers de test. On desire minimiser
@@ -435,17 +701,9 @@ class Tests:
             bbsimulator.params["stat_spd_coeff"] = param_values[1]
 
             tot_err = 0
-            for data_path in training_data_paths:
-                df = pd.read_csv(data_path, sep="\t", index_col=0, skiprows=2, header=0, usecols=[0, 1, 2],
-                                 names=["timestep", "theta_deg", "pos_cm"])
-                init_state = np.zeros((2,))
-                init_state[0] = df.pos_cm[0] / 100
-                init_state[1] = (df.pos_cm[1] - df.pos_cm[0]) / bbsimulator.dt / 100
-                bbsimulator.simulate(lambda timestep, *args, **kwargs: np.deg2rad(df.theta_deg[timestep]),
-                                     command_noise_func, output_noise_func, n_steps=df.shape[0], init_state=init_state)
-                partial_err = np.sum(np.power(np.abs(bbsimulator.all_y[:df.shape[0]].flatten() - df.pos_cm / 100),
-                                              err_pow))
-                tot_err += partial_err
+            for theta_rad, pos_m, init_state in preloaded:
+                tot_err += _fit_sim_error(bbsimulator, theta_rad, pos_m, init_state, command_noise_func,
+                                          output_noise_func, err_pow)
 
             print("[Point {} of {}] Parameters: {};    mean error per file: {}"
                   "".format(run_count[0], tot_runs, np.round(param_values, 5), tot_err / len(training_data_paths)))
@@ -464,15 +722,10 @@ class Tests:
 
         for err_set, data_set in zip((t_errs, v_errs), (training_data_paths, validation_data_paths)):
             for i, t_path in enumerate(data_set):
-                df = pd.read_csv(t_path, sep="\t", index_col=0, skiprows=2, header=0, usecols=[0, 1, 2],
-                                 names=["timestep", "theta_deg", "pos_cm"])
-                init_state = np.zeros((2,))
-                init_state[0] = df.pos_cm[0] / 100
-                init_state[1] = (df.pos_cm[1] - df.pos_cm[0]) / sim.dt / 100
-                sim.simulate(lambda timestep, *args, **kwargs: np.deg2rad(df.theta_deg[timestep]),
-                             n_steps=df.shape[0], init_state=init_state)
-                err = np.sum(np.power(np.abs(sim.all_y[:df.shape[0]].flatten() - df.pos_cm / 100), err_pow))
-                err /= df.shape[0]  # Normaliser par rapport a la longueur du test
+                theta_rad, pos_m, init_state = Tests.load_bb_test_output(t_path, sim.dt)
+                sim.simulate_array(theta_rad, n_steps=pos_m.size, init_state=init_state)
+                err = Tests.sim_error(sim.all_y[:pos_m.size], pos_m, err_pow)
+                err /= pos_m.size  # Normaliser par rapport a la longueur du test
 
                 # Retirer l'outlier
                 if err <= 0.20:
@@ -489,7 +742,6 @@ if __name__ == "__main__":
     from BBSimulators import BBThetaSimulator
     import random
     import time
-    import os
 
     np.set_printoptions(linewidth=200)  # Commenter si problemes d'affichage.
 